@@ -1,16 +1,47 @@
 import streamlit as st
-import google.generativeai as genai
-from fpdf import FPDF
-import qrcode
-import tempfile
-import os
-from supabase import create_client, Client
+import io
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 # --- 1. CONFIGURATION & SETUP ---
 st.set_page_config(page_title="The Opportunity CV", page_icon="🎓", layout="wide")
 
+# Bump whenever the prompt template changes so cached generations are invalidated.
+PROMPT_VERSION = "v2"
+
+# Static instructions go first and stay byte-identical across calls so the
+# provider's prompt cache can reuse the prefix; user input is appended after it.
+STATIC_PROMPT = """
+    You are an expert Resume Writer and ATS Algorithm Specialist. 
+    Rewrite the "Old Experience" given below to perfectly match the "Target Job".
+
+    STRICT INSTRUCTIONS:
+    1. KEYWORD MATCHING: Identify the top 5 hard skills/keywords from the Target Job and ensure they appear naturally in the rewritten bullets.
+    2. FORMAT: Use standard bullet points. Start every bullet with a strong Action Verb (e.g., Led, Developed, Analyzed).
+    3. METRICS: Wherever possible, imply or include impact (e.g., "resulting in improved efficiency" or "impacting X stakeholders").
+    4. TONE: Professional, corporate, and direct.
+    5. FORBIDDEN: Do NOT use em-dashes (—). Use only standard hyphens (-). Do NOT use generic buzzwords like "hard worker."
+
+    OUTPUT FORMAT:
+    Provide ONLY the bullet points. No introductory text. No explanations.
+"""
+
+# Cheap local sanity check so malformed emails never reach the DB or the AI
+_EMAIL_RE = re.compile(r'^[^@\s]+@[^@\s]+\.[^@\s]+$')
+
+# PDF page edges (mm) for the rule drawn under each section header
+PAGE_LEFT = 10
+PAGE_RIGHT = 200
+
 # --- 2. HELPER FUNCTIONS ---
 
+# Built once at import so clean_text does a single C-level pass per call.
+_CLEAN_TABLE = str.maketrans({
+    '\u2018': "'", '\u2019': "'", '\u201c': '"', '\u201d': '"',
+    '\u2013': '-', '\u2014': '-', '\u2022': '-', '…': '...'
+})
+
 def clean_text(text):
     """
     Sanitizes text for ATS and PDF compatibility.
@@ -19,15 +50,8 @@ def clean_text(text):
     - Forces Latin-1 encoding to prevent PDF crashes.
     """
     if not text: return ""
-    replacements = {
-        '\u2018': "'", '\u2019': "'", '\u201c': '"', '\u201d': '"',
-        '\u2013': '-', '\u2014': '-', '\u2022': '-', '…': '...'
-    }
-    for char, replacement in replacements.items():
-        text = text.replace(char, replacement)
-    
-    # Final scrub for any remaining non-standard dashes
-    text = text.replace("—", "-").replace("–", "-")
+    text = text.translate(_CLEAN_TABLE)
+    if text.isascii(): return text # Common case: nothing left to sanitize
     
     return text.encode('latin-1', 'replace').decode('latin-1')
 
@@ -35,12 +59,170 @@ def clean_text(text):
 def init_db():
     """Initializes the database connection only once."""
     try:
+        from supabase import create_client # Deferred: heavy import, only needed on Generate
         url = st.secrets["SUPABASE_URL"]
         key = st.secrets["SUPABASE_KEY"]
         return create_client(url, key)
     except Exception as e:
         return None
 
+@st.cache_resource
+def get_executor():
+    """Shared worker pool for background jobs that the user shouldn't wait on."""
+    return ThreadPoolExecutor(max_workers=2)
+
+def log_submission(supabase, data):
+    """Saves a submission row. Runs on the background executor, so failures are only logged."""
+    try:
+        supabase.table("submissions").insert(data).execute()
+        print(f"Log: Saved data for {data['email']}")
+    except Exception as e:
+        print(f"DB Log Failed: {e}")
+
+@st.cache_resource
+def get_genai_lock():
+    """
+    genai.configure() swaps one process-wide client. get_model holds this lock from
+    configure() until its model has bound that client, so keys never cross sessions.
+    """
+    return threading.Lock()
+
+@st.cache_resource(show_spinner=False)
+def get_model(api_key):
+    """Configures Gemini and picks the best available model once per API key."""
+    import google.generativeai as genai # Deferred: pulls in grpc/protobuf at import time
+    from google.generativeai import client as genai_client
+
+    with get_genai_lock():
+        genai.configure(api_key=api_key)
+
+        # 1. Ask Google what models are actually available for this Key
+        available_models = []
+        for m in genai.list_models():
+            if 'generateContent' in m.supported_generation_methods:
+                available_models.append(m.name)
+
+        # 2. Pick the smartest model available (The "Gemini 3" Logic)
+        if 'models/gemini-1.5-pro' in available_models:
+            target_model = 'gemini-1.5-pro' # The "Gemini 3" feel
+        elif 'models/gemini-1.5-flash' in available_models:
+            target_model = 'gemini-1.5-flash'
+        elif 'models/gemini-pro' in available_models:
+            target_model = 'gemini-pro'
+        else:
+            # If none of the famous ones exist, grab the first one that works
+            target_model = available_models[0] if available_models else 'gemini-1.5-pro'
+
+        # 3. Bind this key's client now; the model would otherwise pick up whatever
+        # key is configured at its first request
+        model = genai.GenerativeModel(target_model)
+        model._client = genai_client.get_default_generative_client()
+
+    # (Optional Debug: Show user which model was picked)
+    print(f"DEBUG: Using model {target_model}")
+    return model
+
+def stream_gemini(api_key, resume, job_desc):
+    """Yields the rewritten experience bullets chunk by chunk as Gemini generates them."""
+    prompt = f"""{STATIC_PROMPT}
+    --- USER INPUT ---
+
+    TARGET JOB DESCRIPTION:
+    {job_desc}
+
+    OLD EXPERIENCE:
+    {resume}
+    """
+
+    for chunk in get_model(api_key).generate_content(prompt, stream=True):
+        yield chunk.text
+
+def job_desc_key(job_desc):
+    """
+    Normalizes a job description for cache keying: re-pasted copies that differ only in
+    case, line breaks or spacing share an entry. Punctuation is kept ("C++" vs "C#").
+    """
+    return " ".join(job_desc.lower().split())
+
+@st.cache_data(max_entries=1024, persist="disk", show_spinner=False)
+def cached_experience(resume, job_key, prompt_version, _generated=None):
+    """
+    Memoizes finished generations so repeat inputs skip the AI call, across restarts too.
+    Keyed on the resume, job_desc_key() and prompt version only, so community-key and
+    user-key requests share entries.
+    - Called without `_generated` it is a lookup: a miss raises KeyError, and
+      Streamlit never caches exceptions, so nothing is stored.
+    - Called with the streamed text (the underscore keeps it out of the key) it stores it.
+    """
+    if _generated is None:
+        raise KeyError(prompt_version)
+    return _generated
+
+@st.cache_data(show_spinner=False)
+def qr_png_bytes(url):
+    """Renders the video-pitch QR code as PNG bytes, once per URL."""
+    import segno
+    buf = io.BytesIO()
+    # make_qr: never Micro QR (phone cameras can't scan it); fixed level M like the old qrcode setup
+    segno.make_qr(url, error='M', boost_error=False).save(buf, kind='png', scale=10, border=2)
+    return buf.getvalue()
+
+# --- PDF BUILDER FUNCTIONS ---
+
+def add_section(pdf, title, body):
+    """Draws one titled resume section (header, rule, body text) onto the PDF."""
+    if body:
+        clean_body = clean_text(body)
+        pdf.set_font(style="B", size=12) # Family stays Times
+        pdf.cell(0, 6, title.upper(), new_x="LMARGIN", new_y="NEXT")
+        # Draw a clean line under the header
+        pdf.line(PAGE_LEFT, pdf.get_y(), PAGE_RIGHT, pdf.get_y())
+        pdf.ln(2)
+        # Body Text
+        pdf.set_font(style="", size=10.5) # Back to body text
+        # Wrap line by line rather than rewrapping the whole block at once
+        for line in clean_body.split('\n'):
+            if line.strip():
+                pdf.multi_cell(0, 5, line, new_x="LMARGIN", new_y="NEXT")
+            else:
+                pdf.ln(5) # Keep blank-line spacing
+        pdf.ln(4) # Space after section
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def build_pdf_bytes(name, contact, video_url, education, skills, final_exp, volunteering, awards):
+    """Assembles the resume PDF. Re-downloads with unchanged inputs are served from cache."""
+    from fpdf import FPDF # Deferred until someone actually downloads
+    pdf = FPDF()
+    pdf.add_page()
+    pdf.set_auto_page_break(auto=True, margin=15)
+
+    # 1. HEADER (Name & Contact)
+    pdf.set_font("Times", "B", 22)
+    pdf.cell(0, 10, clean_text(name), new_x="LMARGIN", new_y="NEXT", align="C")
+    pdf.set_font("Times", "", 10)
+    pdf.cell(0, 5, clean_text(contact), new_x="LMARGIN", new_y="NEXT", align="C")
+
+    # 2. QR CODE (Optional)
+    if video_url:
+        # Position Top Right (fpdf2 reads the PNG straight from memory)
+        with io.BytesIO(qr_png_bytes(video_url)) as qr_buf:
+            pdf.image(qr_buf, x=170, y=10, w=22)
+        pdf.set_xy(170, 32)
+        pdf.set_font("Times", "I", 7)
+        pdf.cell(22, 4, "Video Intro", align="C", link=video_url)
+
+    pdf.ln(8) # Space after header
+    pdf.set_font("Times", "", 10.5) # Body font, standard readable size
+
+    # 3. SECTIONS (Order optimized for Freshers/Career Switchers)
+    add_section(pdf, "Education", education)
+    add_section(pdf, "Technical Skills", skills)
+    add_section(pdf, "Professional Experience", final_exp) # The AI Rewritten part
+    add_section(pdf, "Volunteering & Social Work", volunteering)
+    add_section(pdf, "Awards & Grants", awards)
+
+    return bytes(pdf.output()) # fpdf2 returns a bytearray, no re-encoding needed
+
 # --- 3. SIDEBAR ---
 with st.sidebar:
     st.header("⚙️ Intelligence Engine")
@@ -52,122 +234,101 @@ with st.sidebar:
         api_key = st.text_input("Google Gemini API Key", type="password", help="Get free key at aistudio.google.com")
         
     st.markdown("---")
-    st.info("🔒 Data Privacy: Your resume is processed in memory and not permanently stored.")
+    st.info("🔒 Data Privacy: Rewritten bullets are cached on this server's disk, keyed on your resume and job description, so repeat requests skip the AI call. Cached entries do not expire; they stay until the operator clears the cache.")
 
 # --- 4. MAIN UI ---
 st.title("🎓 The Opportunity CV")
 st.markdown("### The ATS-Crushing Resume Builder")
 
-col1, col2 = st.columns(2)
+# A form batches every field into a single rerun on submit instead of one per edit
+with st.form("resume_form"):
+    col1, col2 = st.columns(2)
 
-with col1:
-    st.subheader("1. Profile")
-    user_name = st.text_input("Full Name", placeholder="Jane Doe")
-    user_email = st.text_input("Email (Required)", placeholder="jane@example.com")
-    contact_info = st.text_input("Contact Info", placeholder="London | +44 7700 900000")
-    video_url = st.text_input("Video Pitch Link", placeholder="https://youtube.com/...")
+    with col1:
+        st.subheader("1. Profile")
+        user_name = st.text_input("Full Name", placeholder="Jane Doe")
+        user_email = st.text_input("Email (Required)", placeholder="jane@example.com")
+        contact_info = st.text_input("Contact Info", placeholder="London | +44 7700 900000")
+        video_url = st.text_input("Video Pitch Link", placeholder="https://youtube.com/...")
     
-    st.markdown("---")
-    st.markdown("**Resume Sections**")
-    education_text = st.text_area("Education", height=100, placeholder="Harvard University, B.A. Economics (2024)")
-    skills_text = st.text_area("Technical Skills", height=80, placeholder="Python, Policy Analysis, Data Visualization")
-    awards_text = st.text_area("Awards", height=80, placeholder="Fulbright Scholar, Dean's List")
-    volunteering_text = st.text_area("Volunteering / Social Work", height=80, placeholder="Community Organizer, Flood Relief Drive")
+        st.markdown("---")
+        st.markdown("**Resume Sections**")
+        education_text = st.text_area("Education", height=100, placeholder="Harvard University, B.A. Economics (2024)")
+        skills_text = st.text_area("Technical Skills", height=80, placeholder="Python, Policy Analysis, Data Visualization")
+        awards_text = st.text_area("Awards", height=80, placeholder="Fulbright Scholar, Dean's List")
+        volunteering_text = st.text_area("Volunteering / Social Work", height=80, placeholder="Community Organizer, Flood Relief Drive")
     
-    st.markdown("**Professional Experience**")
-    current_resume = st.text_area("Paste Old Experience Bullets", height=200, help="Paste your raw bullet points here.")
+        st.markdown("**Professional Experience**")
+        current_resume = st.text_area("Paste Old Experience Bullets", height=200, help="Paste your raw bullet points here.")
 
-with col2:
-    st.subheader("2. Target")
-    job_desc = st.text_area("Paste Job Description (for ATS Tailoring)", height=600, help="The AI will extract keywords from this to rewrite your experience.")
+    with col2:
+        st.subheader("2. Target")
+        job_desc = st.text_area("Paste Job Description (for ATS Tailoring)", height=600, help="The AI will extract keywords from this to rewrite your experience.")
+
+    submitted = st.form_submit_button("✨ Generate Resume", type="primary")
 
 # --- 5. LOGIC ENGINE ---
-if st.button("✨ Generate Resume", type="primary"):
+if submitted:
+    user_email = user_email.strip() # Validate and store the same value
     if not api_key:
         st.error("⚠️ API Key is missing.")
     elif not current_resume or not job_desc or not user_email:
         st.error("⚠️ Please fill in Email, Resume, and Job Description.")
+    elif not _EMAIL_RE.match(user_email):
+        st.error("⚠️ Invalid email format.")
     else:
-        # A. DATABASE LOGGING
+        # A. DATABASE LOGGING (fire-and-forget, overlaps with the AI call below)
         supabase = init_db()
         if supabase:
-            try:
-                data = {
-                    "name": user_name,
-                    "email": user_email,
-                    "resume_text": current_resume,
-                    "job_description": job_desc
-                }
-                supabase.table("submissions").insert(data).execute()
-                print(f"Log: Saved data for {user_email}")
-            except Exception as e:
-                print(f"DB Log Failed: {e}") 
+            data = {
+                "name": user_name,
+                "email": user_email,
+                "resume_text": current_resume,
+                "job_description": job_desc
+            }
+            get_executor().submit(log_submission, supabase, data)
         
       # B. AI GENERATION (Auto-Detect Model)
         try:
-            genai.configure(api_key=api_key)
-            
-            # 1. Ask Google what models are actually available for this Key
-            available_models = []
+            # 1. Configure + pick the model (cached per key, so only the first click pays)
             try:
-                for m in genai.list_models():
-                    if 'generateContent' in m.supported_generation_methods:
-                        available_models.append(m.name)
+                model = get_model(api_key)
             except Exception as e:
                 st.error(f"⚠️ Key Error: Your API Key works, but cannot list models. Error: {e}")
                 st.stop()
+            target_model = model.model_name
 
-            # 2. Pick the smartest model available (The "Gemini 3" Logic)
-            if 'models/gemini-1.5-pro' in available_models:
-                target_model = 'gemini-1.5-pro' # The "Gemini 3" feel
-            elif 'models/gemini-1.5-flash' in available_models:
-                target_model = 'gemini-1.5-flash'
-            elif 'models/gemini-pro' in available_models:
-                target_model = 'gemini-pro'
-            else:
-                # If none of the famous ones exist, grab the first one that works
-                target_model = available_models[0] if available_models else 'gemini-1.5-pro'
-
-            # 3. Run the Engine
-            model = genai.GenerativeModel(target_model)
-            
-            # (Optional Debug: Show user which model was picked)
-            print(f"DEBUG: Using model {target_model}") 
-
-            with st.spinner(f"🤖 AI ({target_model.split('/')[-1]}) is rewriting your resume..."):
-                prompt = f"""
-                You are an expert Resume Writer and ATS Algorithm Specialist. 
-                Rewrite the following "Old Experience" to perfectly match the "Target Job".
-
-                TARGET JOB DESCRIPTION:
-                {job_desc}
-
-                OLD EXPERIENCE:
-                {current_resume}
-
-                STRICT INSTRUCTIONS:
-                1. KEYWORD MATCHING: Identify the top 5 hard skills/keywords from the Target Job and ensure they appear naturally in the rewritten bullets.
-                2. FORMAT: Use standard bullet points. Start every bullet with a strong Action Verb (e.g., Led, Developed, Analyzed).
-                3. METRICS: Wherever possible, imply or include impact (e.g., "resulting in improved efficiency" or "impacting X stakeholders").
-                4. TONE: Professional, corporate, and direct.
-                5. FORBIDDEN: Do NOT use em-dashes (—). Use only standard hyphens (-). Do NOT use generic buzzwords like "hard worker."
-                
-                OUTPUT FORMAT:
-                Provide ONLY the bullet points. No introductory text. No explanations.
-                """
-                
-                response = model.generate_content(prompt)
-                st.session_state['generated_experience'] = response.text
-                st.session_state['step'] = 2
+            job_key = job_desc_key(job_desc)
+            try:
+                generated = cached_experience(current_resume, job_key, PROMPT_VERSION)
+            except KeyError:
+                # Stream tokens into the page; the spinner only covers time-to-first-token
+                placeholder = st.empty()
+                try:
+                    chunks = stream_gemini(api_key, current_resume, job_desc)
+                    with st.spinner(f"🤖 AI ({target_model.split('/')[-1]}) is rewriting your resume..."):
+                        generated = next(chunks, "")
+                    placeholder.markdown(generated)
+                    for chunk in chunks:
+                        generated += chunk
+                        placeholder.markdown(generated)
+                finally:
+                    # The editable copy below takes over; on failure, don't leave half-written bullets
+                    placeholder.empty()
+                cached_experience(current_resume, job_key, PROMPT_VERSION, generated)
+
+            st.session_state['generated_experience'] = generated
+            st.session_state['step'] = 2
 
         except Exception as e:
             st.error(f"AI Error: {str(e)}")
             st.info("💡 Tip: If this says '404', your API Key might be from the wrong Google service. Try creating a new key at aistudio.google.com")
 
 # --- 6. PDF GENERATION ---
-if 'step' in st.session_state and st.session_state['step'] >= 2:
-    st.divider()
-    st.header("3. Final Polish")
+@st.fragment
+def final_polish():
+    """Editing and downloading rerun only this block, not the whole app."""
+    profile = st.session_state['profile']
     col_edit, col_preview = st.columns([1, 1])
     
     with col_edit:
@@ -176,56 +337,11 @@ if 'step' in st.session_state and st.session_state['step'] >= 2:
     with col_preview:
         if st.button("📥 Download PDF"):
             try:
-                pdf = FPDF()
-                pdf.add_page()
-                pdf.set_auto_page_break(auto=True, margin=15)
-                
-                # --- PDF BUILDER FUNCTIONS ---
-                def add_section(title, body):
-                    if body:
-                        clean_body = clean_text(body)
-                        pdf.set_font("Times", "B", 12)
-                        pdf.cell(0, 6, title.upper(), ln=True)
-                        # Draw a clean line under the header
-                        pdf.line(10, pdf.get_y(), 200, pdf.get_y())
-                        pdf.ln(2)
-                        # Body Text
-                        pdf.set_font("Times", "", 10.5) # Standard readable size
-                        pdf.multi_cell(0, 5, clean_body)
-                        pdf.ln(4) # Space after section
-
-                # 1. HEADER (Name & Contact)
-                pdf.set_font("Times", "B", 22)
-                pdf.cell(0, 10, clean_text(user_name), ln=True, align="C")
-                pdf.set_font("Times", "", 10)
-                pdf.cell(0, 5, clean_text(contact_info), ln=True, align="C")
-                
-                # 2. QR CODE (Optional)
-                if video_url:
-                    qr = qrcode.QRCode(box_size=10, border=2)
-                    qr.add_data(video_url)
-                    qr.make(fit=True)
-                    img = qr.make_image(fill_color="black", back_color="white")
-                    with tempfile.NamedTemporaryFile(delete=False, suffix=".png") as tmp_file:
-                        img.save(tmp_file.name)
-                        qr_path = tmp_file.name
-                    # Position Top Right
-                    pdf.image(qr_path, x=170, y=10, w=22)
-                    pdf.set_xy(170, 32)
-                    pdf.set_font("Times", "I", 7)
-                    pdf.cell(22, 4, "Video Intro", align="C", link=video_url)
-                    os.unlink(qr_path)
-                
-                pdf.ln(8) # Space after header
-
-                # 3. SECTIONS (Order optimized for Freshers/Career Switchers)
-                add_section("Education", education_text)
-                add_section("Technical Skills", skills_text)
-                add_section("Professional Experience", final_exp) # The AI Rewritten part
-                add_section("Volunteering & Social Work", volunteering_text)
-                add_section("Awards & Grants", awards_text)
-
-                html_pdf = pdf.output(dest="S").encode("latin-1", errors='replace')
+                html_pdf = build_pdf_bytes(
+                    profile['user_name'], profile['contact_info'], profile['video_url'],
+                    profile['education_text'], profile['skills_text'], final_exp,
+                    profile['volunteering_text'], profile['awards_text'],
+                )
                 st.download_button(
                     label="Download ATS-Optimized PDF",
                     data=html_pdf,
@@ -234,3 +350,18 @@ if 'step' in st.session_state and st.session_state['step'] >= 2:
                 )
             except Exception as e:
                 st.error(f"PDF Error: {str(e)}")
+
+if 'step' in st.session_state and st.session_state['step'] >= 2:
+    # Hand the form values to the fragment, which can rerun without the rest of the script
+    st.session_state['profile'] = {
+        'user_name': user_name,
+        'contact_info': contact_info,
+        'video_url': video_url,
+        'education_text': education_text,
+        'skills_text': skills_text,
+        'volunteering_text': volunteering_text,
+        'awards_text': awards_text,
+    }
+    st.divider()
+    st.header("3. Final Polish")
+    final_polish()